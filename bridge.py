@@ -6,49 +6,198 @@
 
 import asyncio
 import aiosc
-import itertools
+import signal
+import socket
 import monome
 
-class GridGate(aiosc.OSCProtocol):
-    def __init__(self, prefix, bridge):
+try:
+    import liblo
+except ImportError:
+    # pyliblo3 is the maintained fork of pyliblo, with the same api
+    try:
+        import pyliblo3 as liblo
+    except ImportError:
+        liblo = None
+
+# larger kernel buffers for the gate socket, so bursts of led messages from
+# the app aren't dropped while the loop is busy
+GATE_RCVBUF = 2 * 1024 * 1024
+GATE_SNDBUF = 1 * 1024 * 1024
+
+# led states for every possible row byte, same bit order as monome.unpack_row
+ROW_BITS = tuple(bytes((i >> b) & 1 for b in range(8)) for i in range(256))
+
+def unpack_rows(rows):
+    return b''.join([ROW_BITS[int(r) & 0xff] for r in rows])
+
+class GridFrame:
+    # collects led updates coming from the app and sends the quads that
+    # changed to the grid once per loop iteration, so a burst of led/set
+    # messages ends up as a few led/map messages
+    def __init__(self, grid, loop):
+        self.grid = grid
+        self.width = grid.width
+        self.height = grid.height
+        self._loop = loop
+
+        self._pending = bytearray(self.width * self.height)
+        # 255 never matches a led state, so each quad is sent once initially
+        self._sent = bytearray(b'\xff' * (self.width * self.height))
+        self._flush_scheduled = False
+
+    def _set(self, x, y, s):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self._pending[y * self.width + x] = 1 if s else 0
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self.flush)
+
+    def led_set(self, x, y, s):
+        self._set(x, y, s)
+        self._schedule_flush()
+
+    def led_all(self, s):
+        self._pending[:] = bytes([1 if s else 0]) * len(self._pending)
+        self._schedule_flush()
+
+    def led_map(self, x_offset, y_offset, data):
+        for i, s in zip(range(64), data):
+            self._set(x_offset + i % 8, y_offset + i // 8, s)
+        self._schedule_flush()
+
+    def led_row(self, x_offset, y, data):
+        for i, s in enumerate(data):
+            self._set(x_offset + i, y, s)
+        self._schedule_flush()
+
+    def led_col(self, x, y_offset, data):
+        for i, s in enumerate(data):
+            self._set(x, y_offset + i, s)
+        self._schedule_flush()
+
+    def led_intensity(self, i):
+        self.flush()
+        self.grid.led_intensity(i)
+
+    def tilt_set(self, n, s):
+        self.grid.tilt_set(n, s)
+
+    def flush(self):
+        self._flush_scheduled = False
+
+        if not self.grid.connected:
+            return
+
+        for y_offset in range(0, self.height, 8):
+            for x_offset in range(0, self.width, 8):
+                rows = []
+                for y in range(y_offset, y_offset + 8):
+                    start = y * self.width + x_offset
+                    rows.append(slice(start, start + 8))
+
+                if all(self._pending[r] == self._sent[r] for r in rows):
+                    continue
+
+                for r in rows:
+                    self._sent[r] = self._pending[r]
+                self.grid.led_map(x_offset, y_offset, b''.join([self._pending[r] for r in rows]))
+
+class GateHandlers:
+    # handlers for the led messages of the bridged app, shared by the
+    # aiosc and liblo gates
+    def init_handlers(self, prefix, bridge):
         self.prefix = prefix.strip('/')
         self.bridge = bridge
 
-        super().__init__(handlers={
-            '/{}/grid/led/set'.format(self.prefix):
-                lambda addr, path, x, y, s:
-                    # int(), because renoise sends float
-                    self.bridge.grid.led_set(int(x), int(y), int(s)),
-            '/{}/grid/led/all'.format(self.prefix):
-                lambda addr, path, s:
-                    self.bridge.grid.led_all(s),
-            '/{}/grid/led/map'.format(self.prefix):
-                lambda addr, path, x_offset, y_offset, *s:
-                    self.bridge.grid.led_map(x_offset, y_offset, list(itertools.chain(*[monome.unpack_row(r) for r in s]))),
-            '/{}/grid/led/row'.format(self.prefix):
-                lambda addr, path, x_offset, y, *s:
-                    self.bridge.grid.led_row(x_offset, y, list(itertools.chain(*[monome.unpack_row(r) for r in s]))),
-            '/{}/grid/led/col'.format(self.prefix):
-                lambda addr, path, x, y_offset, *s:
-                    self.bridge.grid.led_col(x, y_offset, list(itertools.chain(*[monome.unpack_row(r) for r in s]))),
-            '/{}/grid/led/intensity'.format(self.prefix):
-                lambda addr, path, i:
-                    self.bridge.grid.led_intensity(i),
-            '/{}/tilt/set'.format(self.prefix):
-                lambda addr, path, n, s:
-                    self.bridge.grid.tilt_set(n, s),
-        })
+        self._key_path = '/{}/grid/key'.format(self.prefix)
 
-    def grid_key(self, x, y, s):
-        self.send('/{}/grid/key'.format(self.prefix), x, y, s, addr=(self.bridge._app_host, self.bridge._app_port))
+        self._frame = bridge.frame
+        self._suffix_handlers = {
+            'grid/led/set': self._led_set,
+            'grid/led/all': self._frame.led_all,
+            'grid/led/map': self._led_map,
+            'grid/led/row': self._led_row,
+            'grid/led/col': self._led_col,
+            'grid/led/intensity': self._frame.led_intensity,
+            'tilt/set': self._frame.tilt_set,
+        }
+
+    def _led_set(self, x, y, s):
+        # int(), because renoise sends float
+        self._frame.led_set(int(x), int(y), int(s))
+
+    def _led_map(self, x_offset, y_offset, *s):
+        self._frame.led_map(int(x_offset), int(y_offset), unpack_rows(s))
+
+    def _led_row(self, x_offset, y, *s):
+        self._frame.led_row(int(x_offset), int(y), unpack_rows(s))
+
+    def _led_col(self, x, y_offset, *s):
+        self._frame.led_col(int(x), int(y_offset), unpack_rows(s))
+
+class GridGate(GateHandlers, aiosc.OSCProtocol):
+    def __init__(self, prefix, bridge):
+        self.init_handlers(prefix, bridge)
+        self._key_addr = bridge._app_sockaddr
+
+        # messages under the app prefix are dispatched directly by their
+        # path suffix instead of going through aiosc's pattern matching
+        self._path_prefix = '/{}/'.format(self.prefix)
 
-class GridBridge(monome.GridApp):
-    def __init__(self, bridge_host='127.0.0.1', bridge_port=8080, app_host='127.0.0.1', app_port=8000, app_prefix='/monome', loop=None):
         super().__init__()
 
-        if loop is None:
-            loop = asyncio.get_event_loop()
+    def datagram_received(self, data, addr):
+        if not data.startswith(b'#bundle'):
+            path, args = aiosc.parse_message(data)
+            if path.startswith(self._path_prefix):
+                handler = self._suffix_handlers.get(path[len(self._path_prefix):])
+                if handler is not None:
+                    handler(*args)
+                    return
+
+        super().datagram_received(data, addr)
+
+    def grid_key(self, x, y, s):
+        self.send(self._key_path, x, y, s, addr=self._key_addr)
+
+    def close(self):
+        self.transport.close()
+
+class LibloGate(GateHandlers):
+    # parses incoming osc with liblo in a server thread, then runs the
+    # handlers on the loop; liblo servers listen on all interfaces, so
+    # bridge_host is not used here
+    def __init__(self, prefix, bridge, loop):
+        self.init_handlers(prefix, bridge)
         self._loop = loop
+        self._target = liblo.Address(bridge._app_sockaddr[0], bridge._app_sockaddr[1], liblo.UDP)
+
+        self.server = liblo.ServerThread(bridge._bridge_port)
+        for suffix, handler in self._suffix_handlers.items():
+            self.server.add_method('/{}/{}'.format(self.prefix, suffix), None, self._forward(handler))
+        self.server.start()
+
+    def _forward(self, handler):
+        # liblo passes as many arguments as the callback takes positionally,
+        # so it takes exactly (path, args); it also returns None, as liblo
+        # reads other return values as a status
+        def callback(path, args):
+            self._loop.call_soon_threadsafe(handler, *args)
+        return callback
+
+    def grid_key(self, x, y, s):
+        # send from the server port, like the aiosc gate does
+        self.server.send(self._target, self._key_path, x, y, s)
+
+    def close(self):
+        self.server.stop()
+        self.server.free()
+
+class GridBridge(monome.GridApp):
+    def __init__(self, bridge_host='127.0.0.1', bridge_port=8080, app_host='127.0.0.1', app_port=8000, app_prefix='/monome', use_liblo=False):
+        super().__init__()
 
         self._bridge_host = bridge_host
         self._bridge_port = bridge_port
@@ -57,45 +206,121 @@ class GridBridge(monome.GridApp):
         self._app_port = app_port
         self._app_prefix = app_prefix
 
-        self._gate = None
+        if use_liblo and liblo is None:
+            print('liblo is not available, falling back to aiosc')
+        self._use_liblo = use_liblo and liblo is not None
+
+        # resolve the app address once, instead of on every key message
+        try:
+            self._app_sockaddr = socket.getaddrinfo(app_host, app_port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        except socket.gaierror as e:
+            raise ValueError('cannot resolve app address {}:{}: {}'.format(app_host, app_port, e)) from e
+
+        self.gate = None
+        self.frame = None
+
+        self.connect_task = None
+        self._gate_task = None
 
     def on_grid_ready(self):
-        asyncio.ensure_future(self.init_gate())
+        self._gate_task = asyncio.ensure_future(self.init_gate())
 
     def on_grid_disconnect(self):
         print('{} disconnected'.format(self.grid.id))
-        self.gate.transport.close()
+        self.close_gate()
 
     def on_grid_key(self, x, y, s):
-        self.gate.grid_key(x, y, s)
+        if self.gate is not None:
+            self.gate.grid_key(x, y, s)
+
+    def close_gate(self):
+        if self._gate_task is not None:
+            self._gate_task.cancel()
+            self._gate_task = None
+
+        if self.gate is not None:
+            self.gate.close()
+            self.gate = None
+
+    def close(self):
+        if self.connect_task is not None:
+            self.connect_task.cancel()
+            self.connect_task = None
+
+        self.close_gate()
+
+        if self.grid.connected:
+            self.grid.disconnect()
 
     async def init_gate(self):
         # there is no remote_addr=(self._app_host, self._app_port)
         # because some endpoint implementations (oscP5) are pretty careless
         # about their source ports
-        transport, protocol = await self._loop.create_datagram_endpoint(
+        loop = asyncio.get_running_loop()
+        self.frame = GridFrame(self.grid, loop)
+
+        if self._use_liblo:
+            self.gate = LibloGate(self._app_prefix, self, loop)
+            return
+
+        transport, protocol = await loop.create_datagram_endpoint(
             lambda: GridGate(self._app_prefix, self),
             local_addr=(self._bridge_host, self._bridge_port),
         )
+
+        sock = transport.get_extra_info('socket')
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, GATE_RCVBUF)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, GATE_SNDBUF)
+        except OSError as e:
+            print('could not resize gate socket buffers: {}'.format(e))
+
         self.gate = protocol
 
 if __name__ == '__main__':
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     loop = asyncio.get_event_loop()
 
     device_map = {
         'm0001754': GridBridge(bridge_port=8080, app_host='127.0.0.1', app_port=8000, app_prefix='/monome'),
     }
 
+    # keep references to pending connects, so they aren't garbage collected
+    connect_tasks = set()
+
     def serialosc_device_added(id, type, port):
         if id in device_map:
             bridge_app = device_map[id]
             print('setting up {} for {}'.format(bridge_app.__class__.__name__, id))
-            asyncio.ensure_future(bridge_app.grid.connect('127.0.0.1', port))
+            task = loop.create_task(bridge_app.grid.connect('127.0.0.1', port), name='connect-{}'.format(id))
+            bridge_app.connect_task = task
+            connect_tasks.add(task)
+            task.add_done_callback(connect_tasks.discard)
         else:
             print('no bridge configured for {}'.format(id))
 
+    def shutdown():
+        for bridge_app in device_map.values():
+            bridge_app.close()
+        loop.stop()
+
     serialosc = monome.SerialOsc()
     serialosc.device_added_event.add_handler(serialosc_device_added)
 
+    try:
+        loop.add_signal_handler(signal.SIGINT, shutdown)
+    except NotImplementedError:
+        # no loop signal handlers on windows
+        pass
+
     loop.run_until_complete(serialosc.connect())
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        shutdown()
+    print('kthxbye')
@@ -1,13 +1,86 @@
 import asyncio
 import aiosc
 import time
-import collections
+import threading
 
 try:
     import rtmidi2
 except ImportError:
     pass
 
+class TickWaiters:
+    # wakes pending sync() calls only on the ticks they are waiting for;
+    # each waiter gets its own future, so cancelling one sync() leaves
+    # the rest alone
+    def __init__(self):
+        self._waiters = {}
+        # ticks woken so far; unlike the clock's tick count this is never
+        # reset, so wait_ticks() keeps counting across clock restarts
+        self._elapsed = 0
+        self._counted = {}
+
+    def wait(self, q=1):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(q, []).append(fut)
+        return fut
+
+    def wait_ticks(self, n):
+        # resolves with the number of ticks woken once at least n have been,
+        # more than n if several ticks arrived at once
+        fut = asyncio.get_running_loop().create_future()
+        if n <= 0:
+            fut.set_result(0)
+        else:
+            self._counted.setdefault(self._elapsed + n, []).append((fut, self._elapsed))
+        return fut
+
+    def wake(self, ticks, n=1):
+        # ticks advanced by n since the last wake; every waiter whose
+        # multiple of q was crossed gets that multiple
+        for q in [q for q in self._waiters if ticks // q != (ticks - n) // q]:
+            for fut in self._waiters.pop(q):
+                if not fut.done():
+                    fut.set_result(ticks - ticks % q)
+
+        self._elapsed += n
+        for target in [target for target in self._counted if target <= self._elapsed]:
+            for fut, start in self._counted.pop(target):
+                if not fut.done():
+                    fut.set_result(self._elapsed - start)
+
+class TickTempo:
+    # bpm from an exponential moving average of tick intervals at 24 ppqn,
+    # weighted like a `window`-tick average; plain typed attributes only,
+    # so mypyc can compile the class as is
+    def __init__(self, window: int = 96, bpm: float = 120.0) -> None:
+        self._alpha: float = 2 / (window + 1)
+        # average interval in nanoseconds of the monotonic clock,
+        # 60 s / 24 ppqn = 2.5 s per beat
+        self._interval_ns: float = 2_500_000_000 / bpm
+        # -1 until the first tick, whose interval is not known
+        self._last_tick_ns: int = -1
+        self.bpm: float = bpm
+
+    def reset(self) -> None:
+        # forget the last tick on start/continue, so the pause before it
+        # doesn't count as a tick interval
+        self._last_tick_ns = -1
+
+    def tick(self, n: int = 1) -> float:
+        # n ticks arrived since the previous call
+        current_tick_ns: int = time.monotonic_ns()
+        if self._last_tick_ns < 0:
+            self._last_tick_ns = current_tick_ns
+            return self.bpm
+
+        interval_ns: float = (current_tick_ns - self._last_tick_ns) / n
+        self._last_tick_ns = current_tick_ns
+
+        self._interval_ns += self._alpha * (interval_ns - self._interval_ns)
+        if self._interval_ns > 0:
+            self.bpm = 2_500_000_000 / self._interval_ns
+        return self.bpm
+
 class RtMidiClock:
     def __init__(self, loop=None):
         if loop is None:
@@ -16,10 +89,18 @@ class RtMidiClock:
 
         self.ticks = -1
         self.bpm = 120
-        self._last_tick = time.time()
-        self._tick_intervals = collections.deque(maxlen=96)
+        self._tempo = TickTempo()
+
+        self._tick_waiters = TickWaiters()
 
-        self._tick_event = asyncio.Event()
+        # ticks and start/continue messages received by the midi thread, but
+        # not handled by the loop yet; the loop applies them in order, so
+        # ticks, bpm and tempo are only touched on the loop
+        self._pending_lock = threading.Lock()
+        self._pending_ticks = 0
+        self._pending_start = False
+        self._pending_continue = False
+        self._wakeup_queued = False
 
         self._rtmin = rtmidi2.MidiIn("RtMidiClock")
         self._rtmin.ignore_types(True, False, True)
@@ -36,38 +117,64 @@ class RtMidiClock:
 
     def _on_midi_message(self, msg, time):
         msgtype = msg[0]
-        if msgtype == 248:
-            # tick
-            self._loop.call_soon_threadsafe(self._on_tick)
-        elif msgtype == 250:
-            # start
+        with self._pending_lock:
+            if msgtype == 248:
+                # tick
+                if self.stopped:
+                    return
+                self._pending_ticks += 1
+            elif msgtype == 250:
+                # start; ticks from before it belong to the old count
+                self._pending_ticks = 0
+                self._pending_start = True
+                self.stopped = False
+            elif msgtype == 251:
+                # continue
+                self._pending_continue = True
+                self.stopped = False
+            elif msgtype == 252:
+                # stop
+                self.stopped = True
+                return
+            else:
+                return
+
+            # keep at most one wakeup queued on the loop, it will handle
+            # everything that arrives until it runs
+            wakeup = not self._wakeup_queued
+            self._wakeup_queued = True
+
+        if wakeup:
+            self._loop.call_soon_threadsafe(self._on_pending_ticks)
+
+    def _on_pending_ticks(self):
+        with self._pending_lock:
+            n, self._pending_ticks = self._pending_ticks, 0
+            start, self._pending_start = self._pending_start, False
+            resume, self._pending_continue = self._pending_continue, False
+            self._wakeup_queued = False
+
+        if start:
             self.ticks = -1
-            self.stopped = False
-        elif msgtype == 251:
-            # continue
-            self.stopped = False
-        elif msgtype == 252:
-            # stop
-            self.stopped = True
-
-    def _on_tick(self):
-        if not self.stopped:
-            self.ticks += 1
-
-            # update bpm
-            current_tick = time.time()
-            self._tick_intervals.append(current_tick - self._last_tick)
-            self.bpm = 1 / (sum(self._tick_intervals) / len(self._tick_intervals)) / 24 * 60
-            self._last_tick = current_tick
-
-            self._tick_event.set()
-            self._tick_event.clear()
+        if start or resume:
+            # the pause before start/continue is not a tick interval
+            self._tempo.reset()
+
+        # ticks that piled up while the loop was busy are handled at once,
+        # with a single bpm update and a single wakeup
+        if n > 0:
+            self.ticks += n
+            self.bpm = self._tempo.tick(n)
+            self._tick_waiters.wake(self.ticks, n)
 
     async def sync(self, q=1):
-        await self._tick_event.wait()
-        while self.ticks % q != 0:
-            await self._tick_event.wait()
-        return self.ticks
+        return await self._tick_waiters.wait(q)
+
+    async def wait_ticks(self, n):
+        # waits for n more ticks, counted on the clock rather than timed from
+        # the tempo, so tempo changes on the way are followed; returns the
+        # number of ticks that passed
+        return await self._tick_waiters.wait_ticks(n)
 
 
 class FooClock(aiosc.OSCProtocol):
@@ -76,56 +183,77 @@ class FooClock(aiosc.OSCProtocol):
             '/bang': lambda addr, path, *args: self.__bang_handler(),
             '/start': lambda addr, path, *args: self.__start_handler(),
         })
-        self.__bang_event = asyncio.Event()
+        self.__bang_waiters = TickWaiters()
 
         self.ticks = 0
-        self.last_tick = time.time()
-        self.bang_intervals = collections.deque(maxlen=96)
         self.bpm = 120
+        self.__tempo = TickTempo()
 
     def __bang_handler(self):
         self.ticks += 1
+        self.bpm = self.__tempo.tick()
 
-        current_tick = time.time()
-        self.bang_intervals.append(current_tick - self.last_tick)
-        self.bpm = 1 / (sum(self.bang_intervals) / len(self.bang_intervals)) / 24 * 60
-        self.last_tick = current_tick
-
-        self.__bang_event.set()
-        self.__bang_event.clear()
+        self.__bang_waiters.wake(self.ticks)
 
     def __start_handler(self):
         self.ticks = 0
+        self.__tempo.reset()
 
     async def sync(self, q=1):
-        await self.__bang_event.wait()
-        while self.ticks % q != 0:
-            await self.__bang_event.wait()
-        return self.ticks
+        return await self.__bang_waiters.wait(q)
+
+    async def wait_ticks(self, n):
+        return await self.__bang_waiters.wait_ticks(n)
 
 class InaccurateTempoClock:
     def __init__(self, tempo):
         self.tempo = tempo
         self.ticks = 0
-        self.__bang_event = asyncio.Event()
-        self.__ticktask = asyncio.async(self.__tick())
+        self.__bang_waiters = TickWaiters()
+        # started by the first sync(), so the clock can be created before
+        # the loop is running
+        self.__ticktask = None
+
+    @property
+    def tempo(self):
+        return self._tempo
+
+    @tempo.setter
+    def tempo(self, tempo):
+        self._tempo = tempo
+        self._interval = 60 / tempo / 4 / 24
         self.bpm = tempo
+        # re-anchor, so the new interval is counted from the current tick
+        self._anchor = None
 
     async def __tick(self):
         try:
+            # wake times are computed from an anchor rather than by adding
+            # up sleeps, so scheduling jitter doesn't accumulate into drift
+            loop = asyncio.get_running_loop()
             while True:
+                if self._anchor is None:
+                    self._anchor = loop.time()
+                    self._anchor_ticks = 0
+
                 self.ticks += 1
-                self.__bang_event.set()
-                self.__bang_event.clear()
-                await asyncio.sleep(60 / self.tempo / 4 / 24)
+                self.__bang_waiters.wake(self.ticks)
+                self._anchor_ticks += 1
+                wake_time = self._anchor + self._anchor_ticks * self._interval
+                await asyncio.sleep(max(0, wake_time - loop.time()))
         except asyncio.CancelledError:
             pass
 
     def stop(self):
-        self.__ticktask.cancel()
+        if self.__ticktask:
+            self.__ticktask.cancel()
 
     async def sync(self, q=1):
-        await self.__bang_event.wait()
-        while self.ticks % q != 0:
-            await self.__bang_event.wait()
-        return self.ticks
+        if self.__ticktask is None:
+            self.__ticktask = asyncio.ensure_future(self.__tick())
+        return await self.__bang_waiters.wait(q)
+
+    async def wait_ticks(self, n):
+        if self.__ticktask is None:
+            self.__ticktask = asyncio.ensure_future(self.__tick())
+        return await self.__bang_waiters.wait_ticks(n)
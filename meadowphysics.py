@@ -18,6 +18,11 @@ import monome
 import aalink
 import rtmidi
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from rich.segment import Segment
 from rich.style import Style
 
@@ -48,6 +53,13 @@ s   - start/stop
 
 COUNTERS = 8
 
+# number of outputs the plotter keeps for each counter
+PLOT_LENGTH = 512
+
+# counter updates can come much faster than they can be seen, so the grid
+# and the plotter are redrawn at most this often
+FRAME_INTERVAL = 1 / 30
+
 L3 = 15
 L2 = 9
 L1 = 5
@@ -78,6 +90,12 @@ GLYPHS = [
     [0,   126, 126, 102, 102, 126, 126, 0],  # [] return
 ]
 
+# lit (x, y) positions of each glyph, as drawn in the right half of the grid
+GLYPH_PIXELS = [
+    [(8 + j, i) for i in range(8) for j in range(8) if glyph[i] & (1 << j)]
+    for glyph in GLYPHS
+]
+
 
 def midi_note_name(note):
     note_name = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"][note % 12]
@@ -118,120 +136,286 @@ class State(IntEnum):
     RUNNING = 2
 
 
+# bare int values of the enums above, compared against in the per-tick
+# code; the state lists store plain ints, enums are only used at the
+# preset and ui boundaries
+RULE_INC = int(Rule.INC)
+RULE_DEC = int(Rule.DEC)
+RULE_MAX = int(Rule.MAX)
+RULE_MIN = int(Rule.MIN)
+RULE_RAND = int(Rule.RAND)
+RULE_POLE = int(Rule.POLE)
+RULE_STOP = int(Rule.STOP)
+
+EVENT_NONE = int(Event.NONE)
+EVENT_TRIGGER = int(Event.TRIGGER)
+EVENT_TOGGLE = int(Event.TOGGLE)
+
+# output value of each event after a step, triggers only last for one
+TRIGGER_CLEARED = (EVENT_NONE, EVENT_NONE, EVENT_TOGGLE)
+
+MODE_MAIN = int(Mode.MAIN)
+MODE_EDIT = int(Mode.EDIT)
+
+STATE_STOPPED = int(State.STOPPED)
+STATE_READY = int(State.READY)
+STATE_RUNNING = int(State.RUNNING)
+
+
 class MidiOut:
     def __init__(self):
         self.midi_out = rtmidi.MidiOut(name="meadowphysics")
         # TODO: rtmidi stops sending events unless this line is here
         # self.midi_out.open_port(0)
 
-        self.scale = "major"
-        self.root = 60
+        # tracked here, so sending doesn't have to ask rtmidi every time
+        self._open = False
+
+        # reused for every message, rtmidi copies it when sending
+        self._message = [0, 0, 0]
+
+        # ports are listed from an executor thread, so they get an rtmidi
+        # client of their own instead of sharing the one used for sending
+        self._port_lister = rtmidi.MidiOut(name="meadowphysics ports")
+
+        # each counter has a fixed note, sent with the status bytes of the
+        # current channel; active notes are kept as a bitmask, together
+        # with the (note off status, note) each one was started with
+        self._slot_notes = []
+        self._sent_notes = [None for i in range(COUNTERS)]
+        self._mask = 0
+
+        self._scale = "major"
+        self._scale_list = SCALES[self._scale]
+        self._root = 60
+        self._channel = 1
         self.velocity = 101
-        self.channel = 1
 
-        self.notes = set()
+        self._update_notes()
+        self._update_status()
+
+    # scale and root only change the notes, channel only the status bytes;
+    # velocity is read when sending and isn't cached at all
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, value):
+        self._scale = value
+        self._scale_list = SCALES[value]
+        self._update_notes()
+        self._stop_changed()
+
+    @property
+    def root(self):
+        return self._root
+
+    @root.setter
+    def root(self, value):
+        self._root = value
+        self._update_notes()
+        self._stop_changed()
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @channel.setter
+    def channel(self, value):
+        self._channel = value
+        self._update_status()
+        self._stop_changed()
+
+    def _update_notes(self):
+        scale = self._scale_list
+        self._slot_notes = [self._root + scale[i] for i in range(COUNTERS)]
+
+    def _update_status(self):
+        self._note_on_status = 0x90 | self._channel - 1
+        self._note_off_status = 0x80 | self._channel - 1
+
+    def _stop_changed(self):
+        # stop active notes that no longer match their slot, so they get
+        # started again with the new note or channel
+        for i in range(COUNTERS):
+            if self._mask & (1 << i) and self._sent_notes[i] != (self._note_off_status, self._slot_notes[i]):
+                self._send_note_off(self._sent_notes[i])
+                self._mask &= ~(1 << i)
 
     def pipe(self, output):
-        new_notes = set()
-
+        new_mask = 0
         for i in range(COUNTERS):
-            event = output[i]
+            if output[i] != EVENT_NONE:
+                new_mask |= 1 << i
+
+        note_ons = new_mask & ~self._mask
+        note_offs = self._mask & ~new_mask
+
+        self._mask = new_mask
+
+        while note_ons:
+            i = (note_ons & -note_ons).bit_length() - 1
+            note_ons &= note_ons - 1
 
-            if event != Event.NONE:
-                new_note = (self.channel, self.root + SCALES[self.scale][i])
-                new_notes.add(new_note)
+            self._sent_notes[i] = (self._note_off_status, self._slot_notes[i])
+            self._send_note_on(self._slot_notes[i])
 
-        note_offs = self.notes.difference(new_notes)
-        note_ons = new_notes.difference(self.notes)
+        while note_offs:
+            i = (note_offs & -note_offs).bit_length() - 1
+            note_offs &= note_offs - 1
 
-        self.notes = new_notes
+            self._send_note_off(self._sent_notes[i])
 
-        for channel, note in note_ons:
-            self.note_on(channel, note, self.velocity)
+    def _send(self, status, note, velocity):
+        message = self._message
+        message[0] = status
+        message[1] = note
+        message[2] = velocity
+        self.midi_out.send_message(message)
 
-        for channel, note in note_offs:
-            self.note_off(channel, note)
+    def _send_note_on(self, note):
+        if self._open:
+            self._send(self._note_on_status, note, self.velocity)
 
-    def note_on(self, channel, note, velocity):
-        if self.midi_out.is_port_open():
-            self.midi_out.send_message([0x90 | channel - 1, note, velocity])
+    def _send_note_off(self, sent):
+        if self._open:
+            self._send(sent[0], sent[1], 0)
 
-    def note_off(self, channel, note):
-        if self.midi_out.is_port_open():
-            self.midi_out.send_message([0x80 | channel - 1, note, 0])
+    def list_ports(self):
+        return self._port_lister.get_ports()
 
     def open(self, port):
         self.close()
         self.midi_out.open_port(port)
+        self._open = True
 
     def close(self):
-        for channel, note in self.notes:
-            self.note_off(channel, note)
+        for i in range(COUNTERS):
+            if self._mask & (1 << i):
+                self._send_note_off(self._sent_notes[i])
+        self._mask = 0
+        self._open = False
         self.midi_out.close_port()
 
 
-class Counter:
-    def __init__(self, index):
-        self.index = index
-        self.value = 7
-        self.start_value = 7
-        self.range_min = 7
-        self.range_max = 7
-        self.speed = 0
-        self.ticks = 0
+class CounterField:
+    # exposes one entry of a Meadowphysics state list as a counter attribute
+    def __set_name__(self, owner, name):
+        self.name = name
 
-        self.events = [Event.NONE for i in range(COUNTERS)]
-        self.events[index] = Event.TRIGGER
-        self.sync = [False for i in range(COUNTERS)]
-        self.sync[index] = True
+    def __get__(self, counter, owner=None):
+        if counter is None:
+            return self
+        return getattr(counter.mp, self.name)[counter.index]
 
-        self.rule_dest = index
-        self.rule = Rule.INC
+    def __set__(self, counter, value):
+        getattr(counter.mp, self.name)[counter.index] = value
+
+
+class Counter:
+    # a view on the state of one counter, which is stored by Meadowphysics
+    # in per-field lists, so the step loop can run without attribute lookups
+    value = CounterField()
+    start_value = CounterField()
+    range_min = CounterField()
+    range_max = CounterField()
+    speed = CounterField()
+    ticks = CounterField()
+    rule_dest = CounterField()
+    rule = CounterField()
+    state = CounterField()
+
+    def __init__(self, mp, index):
+        self.mp = mp
+        self.index = index
 
-        self.state = State.STOPPED
+        # rows of the shared event and sync matrices
+        self.events = mp.events[index]
+        self.sync = mp.sync[index]
 
     def start(self, delayed=False):
         self.value = self.start_value
-        self.state = State.READY if delayed else State.RUNNING
+        self.state = STATE_READY if delayed else STATE_RUNNING
 
     def stop(self):
         self.value = self.start_value
-        self.state = State.STOPPED
+        self.state = STATE_STOPPED
 
-    def decrement(self):
-        if self.ticks == 0:
-            self.value -= 1
-            self.ticks = self.speed
-        else:
-            self.ticks -= 1
 
-    def apply_rule(self, rule):
-        if rule == Rule.INC:
-            self.start_value += 1
-            if self.start_value > self.range_max:
-                self.start_value = self.range_min
+def rule_start_value(rule, start_value, range_min, range_max, rng):
+    # new start value of a counter after a rule other than STOP is applied
+    if rule == RULE_INC:
+        start_value += 1
+        if start_value > range_max:
+            start_value = range_min
+
+    elif rule == RULE_DEC:
+        start_value -= 1
+        if start_value < range_min:
+            start_value = range_max
+
+    elif rule == RULE_MAX:
+        start_value = range_max
+
+    elif rule == RULE_MIN:
+        start_value = range_min
+
+    elif rule == RULE_RAND:
+        start_value = rng.randrange(range_min, range_max + 1)
 
-        elif rule == Rule.DEC:
-            self.start_value -= 1
-            if self.start_value < self.range_min:
-                self.start_value = self.range_max
+    elif rule == RULE_POLE:
+        distance_to_min = start_value - range_min
+        distance_to_max = range_max - start_value
+        start_value = range_min if distance_to_min > distance_to_max else range_max
+
+    return start_value
+
+
+def step_counters(output, value, start_value, range_min, range_max, speed, ticks, state, rule_dest, rule, events, sync, rng):
+    # advances every counter by one clock step, working on the state lists
+    # of Meadowphysics only
+    output[:] = map(TRIGGER_CLEARED.__getitem__, output)
+
+    for i in range(COUNTERS):
+        if state[i] == STATE_READY:
+            value[i] = start_value[i]
+            state[i] = STATE_RUNNING
+
+        elif state[i] == STATE_RUNNING:
+            if ticks[i] == 0:
+                value[i] -= 1
+                ticks[i] = speed[i]
+            else:
+                ticks[i] -= 1
 
-        elif rule == Rule.MAX:
-            self.start_value = self.range_max
+            if value[i] == -1:
+                value[i] = start_value[i]
+                state[i] = STATE_STOPPED
 
-        elif rule == Rule.MIN:
-            self.start_value = self.range_min
+                dest = rule_dest[i]
+                if rule[i] == RULE_STOP:
+                    value[dest] = start_value[dest]
+                    state[dest] = STATE_STOPPED
+                else:
+                    start_value[dest] = rule_start_value(rule[i], start_value[dest], range_min[dest], range_max[dest], rng)
 
-        elif rule == Rule.RAND:
-            self.start_value = random.randint(self.range_min, self.range_max)
+                counter_events = events[i]
+                counter_sync = sync[i]
 
-        elif rule == Rule.POLE:
-            distance_to_min = self.start_value - self.range_min
-            distance_to_max = self.range_max - self.start_value
-            self.start_value = self.range_min if distance_to_min > distance_to_max else self.range_max
+                for j in range(COUNTERS):
+                    if counter_events[j] == EVENT_TRIGGER:
+                        output[j] = EVENT_TRIGGER
+                    elif counter_events[j] == EVENT_TOGGLE:
+                        if output[j] != EVENT_TOGGLE:
+                            output[j] = EVENT_TOGGLE
+                        else:
+                            output[j] = EVENT_NONE
 
-        elif rule == Rule.STOP:
-            self.stop()
+                    if counter_sync[j]:
+                        value[j] = start_value[j]
+                        state[j] = STATE_RUNNING
 
 
 class Meadowphysics:
@@ -241,9 +425,27 @@ class Meadowphysics:
 
         self.clock_div = 16
 
-        self.counters = [Counter(i) for i in range(COUNTERS)]
-        self.counters[0].state = State.READY
-        self.output = [Event.NONE for i in range(COUNTERS)]
+        # used by the random rule
+        self.rng = random.Random()
+
+        # counter state, one entry per counter
+        self.value = [7 for i in range(COUNTERS)]
+        self.start_value = [7 for i in range(COUNTERS)]
+        self.range_min = [7 for i in range(COUNTERS)]
+        self.range_max = [7 for i in range(COUNTERS)]
+        self.speed = [0 for i in range(COUNTERS)]
+        self.ticks = [0 for i in range(COUNTERS)]
+        self.rule_dest = [i for i in range(COUNTERS)]
+        self.rule = [RULE_INC for i in range(COUNTERS)]
+        self.state = [STATE_STOPPED for i in range(COUNTERS)]
+
+        # events[i][j] and sync[i][j] apply to counter j when counter i fires
+        self.events = [[EVENT_TRIGGER if i == j else EVENT_NONE for j in range(COUNTERS)] for i in range(COUNTERS)]
+        self.sync = [[i == j for j in range(COUNTERS)] for i in range(COUNTERS)]
+
+        self.counters = [Counter(self, i) for i in range(COUNTERS)]
+        self.counters[0].state = STATE_READY
+        self.output = [EVENT_NONE for i in range(COUNTERS)]
 
         self.play_task = None
         self.updated = monome.Event()
@@ -267,36 +469,21 @@ class Meadowphysics:
         self.reset_counters()
 
     def step(self):
-        for i in range(COUNTERS):
-            if self.output[i] == Event.TRIGGER:
-                self.output[i] = Event.NONE
-
-        for i in range(COUNTERS):
-            counter = self.counters[i]
-
-            if counter.state == State.READY:
-                counter.start()
-
-            elif counter.state == State.RUNNING:
-                counter.decrement()
-
-                if counter.value == -1:
-                    counter.stop()
-
-                    rule_dest_counter = self.counters[counter.rule_dest]
-                    rule_dest_counter.apply_rule(counter.rule)
-
-                    for j in range(COUNTERS):
-                        if counter.events[j] == Event.TRIGGER:
-                            self.output[j] = Event.TRIGGER
-                        elif counter.events[j] == Event.TOGGLE:
-                            if self.output[j] != Event.TOGGLE:
-                                self.output[j] = Event.TOGGLE
-                            else:
-                                self.output[j] = Event.NONE
-
-                        if counter.sync[j]:
-                            self.counters[j].start()
+        step_counters(
+            self.output,
+            self.value,
+            self.start_value,
+            self.range_min,
+            self.range_max,
+            self.speed,
+            self.ticks,
+            self.state,
+            self.rule_dest,
+            self.rule,
+            self.events,
+            self.sync,
+            self.rng,
+        )
 
         self.midi.pipe(self.output)
         self.updated.dispatch()
@@ -310,14 +497,14 @@ class Meadowphysics:
         counter.stop()
 
         for i in range(COUNTERS):
-            if counter.events[i] == Event.TOGGLE and self.output[i] == Event.TOGGLE:
-                self.output[i] = Event.NONE
+            if counter.events[i] == EVENT_TOGGLE and self.output[i] == EVENT_TOGGLE:
+                self.output[i] = EVENT_NONE
 
     def reset_counters(self):
         for counter in self.counters:
             counter.start_value = counter.range_min
 
-            if counter.state == State.RUNNING:
+            if counter.state == STATE_RUNNING:
                 counter.start(delayed=True)
 
         self.updated.dispatch()
@@ -327,7 +514,6 @@ class GridInterface(monome.GridApp):
     def __init__(self, mp):
         super().__init__()
         self.mp = mp
-        self.mp.updated.add_handler(self.on_mp_update)
 
         self.mode = Mode.MAIN
         self.edit_mode_counter = self.mp.counters[0]
@@ -335,12 +521,51 @@ class GridInterface(monome.GridApp):
 
         self.buffer = monome.GridBuffer(16, COUNTERS)
 
+        # leds that don't move with the counters are drawn here, and only
+        # redrawn when what they depend on changes
+        self.static_buffer = monome.GridBuffer(16, COUNTERS)
+        self._last_static_key = None
+
+        self._frame_handle = None
+        self._last_frame_time = float("-inf")
+
+        # levels last sent to the grid, a frame is only sent when it differs
+        self._sent_levels = None
+
     def on_mp_update(self):
+        # draw right away unless a frame went out less than FRAME_INTERVAL
+        # ago, otherwise the next frame is drawn once the interval is over
+        if self._frame_handle is not None:
+            return
+
+        loop = asyncio.get_running_loop()
+        delay = self._last_frame_time + FRAME_INTERVAL - loop.time()
+
+        if delay > 0:
+            self._frame_handle = loop.call_later(delay, self.render_frame)
+        else:
+            self.render_frame()
+
+    def render_frame(self):
+        self._frame_handle = None
+        self._last_frame_time = asyncio.get_running_loop().time()
         self.render()
 
     def on_grid_ready(self):
+        # counter updates are only followed while a grid is connected
+        self.mp.updated.add_handler(self.on_mp_update)
+
+        # a newly connected grid shows nothing yet
+        self._sent_levels = None
         self.render()
 
+    def on_grid_disconnect(self):
+        self.mp.updated.remove_handler(self.on_mp_update)
+
+        if self._frame_handle is not None:
+            self._frame_handle.cancel()
+            self._frame_handle = None
+
     def on_grid_key(self, x, y, s):
         if y >= COUNTERS:
             return
@@ -384,9 +609,9 @@ class GridInterface(monome.GridApp):
                 elif x == 3:
                     self.edit_mode_counter.sync[y] = not self.edit_mode_counter.sync[y]
                 elif x == 5:
-                    self.edit_mode_counter.events[y] = Event.TOGGLE if self.edit_mode_counter.events[y] != Event.TOGGLE else Event.NONE
+                    self.edit_mode_counter.events[y] = EVENT_TOGGLE if self.edit_mode_counter.events[y] != EVENT_TOGGLE else EVENT_NONE
                 elif x == 6:
-                    self.edit_mode_counter.events[y] = Event.TRIGGER if self.edit_mode_counter.events[y] != Event.TRIGGER else Event.NONE
+                    self.edit_mode_counter.events[y] = EVENT_TRIGGER if self.edit_mode_counter.events[y] != EVENT_TRIGGER else EVENT_NONE
                 elif x > 7:
                     self.mp.counters[y].speed = x - 8
                     self.mp.counters[y].ticks = self.mp.counters[y].speed
@@ -408,66 +633,98 @@ class GridInterface(monome.GridApp):
 
         self.render()
 
-    def render(self):
-        if not self.grid.connected:
-            return
+    def _static_key(self):
+        # everything the static layer of the current mode is drawn from
+        if self.mode == Mode.MAIN:
+            return (self.mode, tuple(self.mp.range_min), tuple(self.mp.range_max), tuple(self.mp.start_value))
+
+        counter = self.edit_mode_counter
+
+        if self.mode == Mode.EDIT:
+            return (self.mode, counter.index, tuple(counter.sync), tuple(counter.events), tuple(self.mp.speed))
+
+        return (self.mode, counter.index, counter.rule, counter.rule_dest)
 
-        self.buffer.led_all(0)
+    def render_static(self):
+        # draw everything except the running counter values, writing rows
+        # of the buffer directly instead of setting leds one by one
+        self.static_buffer.led_all(0)
+        levels = self.static_buffer.levels
 
         if self.mode == Mode.MAIN:
             for i in range(COUNTERS):
                 counter = self.mp.counters[i]
+                row = levels[i]
 
-                for j in range(counter.range_min, counter.range_max + 1):
-                    self.buffer.led_level_set(j, i, L1)
-
-                self.buffer.led_level_set(counter.start_value, i, L2)
-
-                if counter.state == State.RUNNING:
-                    self.buffer.led_level_set(counter.value, i, L3)
+                row[counter.range_min:counter.range_max + 1] = [L1] * (counter.range_max - counter.range_min + 1)
+                row[counter.start_value] = L2
 
         elif self.mode == Mode.EDIT:
+            sync = self.edit_mode_counter.sync
+            events = self.edit_mode_counter.events
+            speed = self.mp.speed
+
             for i in range(COUNTERS):
-                counter = self.mp.counters[i]
+                row = levels[i]
+                event = events[i]
 
-                if counter.state == State.RUNNING:
-                    self.buffer.led_level_set(counter.value, i, L1)
-                    self.buffer.led_level_set(2, i, L0)
+                row[3] = L2 if sync[i] else L1
+                row[5] = L2 if event == EVENT_TOGGLE else L1
+                row[6] = L2 if event == EVENT_TRIGGER else L1
+                row[8 + speed[i]] = L2
 
-                self.buffer.led_level_set(3, i, L2 if self.edit_mode_counter.sync[i] else L1)
+            levels[self.edit_mode_counter.index][0] = L2
 
-                event = self.edit_mode_counter.events[i]
+        elif self.mode == Mode.RULE:
+            levels[self.edit_mode_counter.rule][8:16] = [L1] * 8
 
-                self.buffer.led_level_set(5, i, L2 if event == Event.TOGGLE else L1)
-                self.buffer.led_level_set(6, i, L2 if event == Event.TRIGGER else L1)
+            for x, y in GLYPH_PIXELS[self.edit_mode_counter.rule]:
+                levels[y][x] = L3
 
-                self.buffer.led_level_set(8 + counter.speed, i, L2)
+            levels[self.edit_mode_counter.rule_dest][5] = L3
+            levels[self.edit_mode_counter.rule_dest][6] = L3
 
-            self.buffer.led_level_set(0, self.edit_mode_counter.index, L2)
+            levels[self.edit_mode_counter.index][0] = L2
+            levels[self.edit_mode_counter.index][1] = L2
 
-        elif self.mode == Mode.RULE:
-            for i in range(COUNTERS):
-                counter = self.mp.counters[i]
+    def render(self):
+        if not self.grid.connected:
+            return
+
+        static_key = self._static_key()
+        if static_key != self._last_static_key:
+            self._last_static_key = static_key
+            self.render_static()
 
-                if counter.state == State.RUNNING:
-                    self.buffer.led_level_set(counter.value, i, L1)
+        levels = self.buffer.levels
+        static_levels = self.static_buffer.levels
 
-            for j in range(8, 16):
-                self.buffer.led_level_set(j, self.edit_mode_counter.rule, L1)
+        for y in range(COUNTERS):
+            levels[y][:] = static_levels[y]
 
-            for i in range(8):
-                glyph_row = GLYPHS[self.edit_mode_counter.rule][i]
+        # overlay running counter values; in main mode they are drawn on
+        # top, in the other modes the static leds are drawn over them
+        state = self.mp.state
+        value = self.mp.value
 
-                for j in range(8):
-                    if glyph_row & (1 << j) != 0:
-                        self.buffer.led_level_set(8 + j, i, L3)
+        for i in range(COUNTERS):
+            if state[i] != STATE_RUNNING:
+                continue
 
-            self.buffer.led_level_set(5, self.edit_mode_counter.rule_dest, L3)
-            self.buffer.led_level_set(6, self.edit_mode_counter.rule_dest, L3)
+            if 0 <= value[i] < 16:
+                if self.mode == MODE_MAIN:
+                    levels[i][value[i]] = L3
+                elif static_levels[i][value[i]] == 0:
+                    levels[i][value[i]] = L1
 
-            self.buffer.led_level_set(0, self.edit_mode_counter.index, L2)
-            self.buffer.led_level_set(1, self.edit_mode_counter.index, L2)
+            if self.mode == MODE_EDIT:
+                levels[i][2] = L0
 
+        # counters with a slow speed leave most frames unchanged
+        if levels == self._sent_levels:
+            return
+
+        self._sent_levels = [row[:] for row in levels]
         self.buffer.render(self.grid)
 
     def disconnect(self):
@@ -635,45 +892,71 @@ class Plotter(Widget):
         }
     """
 
+    # parsed once, segments are immutable and can be shared between lines
+    STYLE_NODATA = Style.parse("dodger_blue3")
+    STYLE_GREEN = Style.parse("bright_green")
+    STYLE_WHITE = Style.parse("bright_white")
+
+    SEGMENT_NODATA = Segment("▪", STYLE_NODATA)
+    SEGMENT_GREEN = Segment("■", STYLE_GREEN)
+    SEGMENT_WHITE = Segment("■", STYLE_WHITE)
+
+    # cell segment for each Event value
+    SEGMENTS = (SEGMENT_NODATA, SEGMENT_GREEN, SEGMENT_GREEN)
+
     def __init__(self, mp, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.mp = mp
         self.mp.updated.add_handler(self.update_log)
 
-        self.__log = [list() for i in range(COUNTERS)]
+        # ring buffers of the last PLOT_LENGTH outputs of each counter
+        self.__log = [bytearray(PLOT_LENGTH) for i in range(COUNTERS)]
+        self.__head = 0
+        self.__fill = 0
+
+        self.__dirty = False
+
+    def on_mount(self):
+        self.set_interval(FRAME_INTERVAL, self.refresh_log)
+
+    def refresh_log(self):
+        if self.__dirty:
+            self.__dirty = False
+            self.refresh()
 
     def update_log(self):
         for i in range(COUNTERS):
-            self.__log[i].append(self.mp.output[i])
+            self.__log[i][self.__head] = self.mp.output[i]
 
-            if len(self.__log[i]) > self.size.width:
-                del self.__log[i][:len(self.__log[i]) - self.size.width]
+        self.__head = (self.__head + 1) % PLOT_LENGTH
+        self.__fill = min(self.__fill + 1, PLOT_LENGTH)
+        self.__dirty = True
 
-        self.refresh()
+    def log_row(self, y):
+        # the outputs of counter y that fit the widget, oldest first
+        row = self.__log[y]
+        start = self.__head - min(self.__fill, self.size.width)
+
+        if start >= 0:
+            return row[start:self.__head]
+        return row[start:] + row[:self.__head]
 
     def render_line(self, y):
         if y >= COUNTERS:
             return Strip.blank(self.size.width)
 
-        data = self.__log[y]
-        segments = []
-
-        style_nodata = Style.parse("dodger_blue3")
-        style_green = Style.parse("bright_green")
-        style_white = Style.parse("bright_white")
+        data = self.log_row(y)
+        table = self.SEGMENTS
+        segments = [table[v] for v in data]
 
-        for i in range(len(data)):
-            if data[i] == Event.TRIGGER or data[i] == Event.TOGGLE:
-                if i == len(data) - 1:
-                    segments.append(Segment("■", style_white))
-                else:
-                    segments.append(Segment("■", style_green))
-            else:
-                segments.append(Segment("▪", style_nodata))
+        # the most recent event is highlighted
+        if segments and data[-1] != EVENT_NONE:
+            segments[-1] = self.SEGMENT_WHITE
 
-        if len(segments) < self.size.width:
-            segments.append(Segment("-" * (self.size.width - len(segments)), style_nodata))
+        pad = self.size.width - len(segments)
+        if pad > 0:
+            segments.append(Segment("-" * pad, self.STYLE_NODATA))
 
         strip = Strip(segments)
         return strip
@@ -818,6 +1101,11 @@ class MeadowphysicsApp(App):
         self.grids = []
         self.midi_ports = []
 
+        # preset files are only looked up on disk once, store_preset keeps
+        # this up to date afterwards
+        self.existing_presets = set()
+        self.scan_presets()
+
     def compose(self):
         with Grid(id="layout"):
             with OptionsPanel():
@@ -866,10 +1154,17 @@ class MeadowphysicsApp(App):
         preset = self.query_one("#preset").value
         self.store_preset(preset)
 
+    def scan_presets(self):
+        self.existing_presets.clear()
+
+        for path in pathlib.Path(".").glob("meadowphysics_preset*.json"):
+            index = path.stem[len("meadowphysics_preset"):]
+            if index.isdigit():
+                self.existing_presets.add(int(index))
+
     def update_recall_button_state(self):
         preset = self.query_one("#preset").value
-        filename = "meadowphysics_preset{:0>2}.json".format(preset)
-        self.query_one("#recall").disabled = not pathlib.Path(filename).exists()
+        self.query_one("#recall").disabled = preset not in self.existing_presets
 
     def store_preset(self, index):
         state = {
@@ -892,18 +1187,22 @@ class MeadowphysicsApp(App):
             state["meadowphysics"]["counters"].append({
                 "range_min": counter.range_min,
                 "range_max": counter.range_max,
-                "events": counter.events,
+                "events": [int(event) for event in counter.events],
                 "sync": counter.sync,
                 "rule_dest": counter.rule_dest,
-                "rule": counter.rule,
-                "state": counter.state,
+                "rule": int(counter.rule),
+                "state": int(counter.state),
             })
 
         filename = "meadowphysics_preset{:0>2}.json".format(index)
 
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(state, f)
+        if orjson:
+            pathlib.Path(filename).write_bytes(orjson.dumps(state))
+        else:
+            with open(filename, "w", encoding="utf-8") as f:
+                json.dump(state, f)
 
+        self.existing_presets.add(index)
         self.update_recall_button_state()
 
     def recall_preset(self, index):
@@ -911,8 +1210,11 @@ class MeadowphysicsApp(App):
 
         filename = "meadowphysics_preset{:0>2}.json".format(index)
 
-        with open(filename, encoding="utf-8") as f:
-            state = json.load(f)
+        if orjson:
+            state = orjson.loads(pathlib.Path(filename).read_bytes())
+        else:
+            with open(filename, encoding="utf-8") as f:
+                state = json.load(f)
 
         if not self.link.enabled or self.link.num_peers == 0:
             self.link.tempo = state["app"]["bpm"]
@@ -938,11 +1240,11 @@ class MeadowphysicsApp(App):
             self.mp.counters[i].range_max = counter_state["range_max"]
 
             self.mp.counters[i].rule_dest = counter_state["rule_dest"]
-            self.mp.counters[i].rule = Rule(counter_state["rule"])
-            self.mp.counters[i].state = State(counter_state["state"])
+            self.mp.counters[i].rule = int(Rule(counter_state["rule"]))
+            self.mp.counters[i].state = int(State(counter_state["state"]))
 
             for j in range(COUNTERS):
-                self.mp.counters[i].events[j] = Event(counter_state["events"][j])
+                self.mp.counters[i].events[j] = int(Event(counter_state["events"][j]))
                 self.mp.counters[i].sync[j] = counter_state["sync"][j]
 
         self.mp.reset_counters()
@@ -1023,9 +1325,11 @@ class MeadowphysicsApp(App):
 
         asyncio.create_task(serialosc.connect())
 
-        def poll_midi_ports():
-            midi_out = self.midi.midi_out
-            new_ports = [(name, value) for value, name in enumerate(midi_out.get_ports())]
+        async def poll_midi_ports():
+            # enumerating the backend's devices can take a while, so it
+            # doesn't run on the event loop
+            names = await asyncio.get_running_loop().run_in_executor(None, self.midi.list_ports)
+            new_ports = [(name, value) for value, name in enumerate(names)]
 
             if new_ports == self.midi_ports:
                 return
@@ -1034,9 +1338,13 @@ class MeadowphysicsApp(App):
             self.midi_ports = new_ports
             midi_select.set_options(self.midi_ports)
 
-        poll_midi_ports()
+        async def start_polling_midi_ports():
+            # the timer starts after the first poll is done, so polls never
+            # overlap and the port lister is only used by one thread at a time
+            await poll_midi_ports()
+            self.set_interval(1, poll_midi_ports)
 
-        self.set_interval(1, poll_midi_ports)
+        asyncio.create_task(start_polling_midi_ports())
         self.set_interval(1, lambda: bpm.set_value(self.link.tempo, False))
 
 
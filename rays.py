@@ -22,6 +22,19 @@ def cancel_task(task):
     if task:
         task.cancel()
 
+class Column:
+    # playback settings of a column; key presses change them and wake the
+    # column's play task instead of replacing it, speed 0 means stopped
+    def __init__(self):
+        self.speed = 0
+        self.dur = 1
+        self.changed = asyncio.Event()
+
+    def set(self, speed, dur=1):
+        self.speed = speed
+        self.dur = dur
+        self.changed.set()
+
 class Flin(monome.App):
     def __init__(self, clock, synth, channel, clockdiv=6):
         super().__init__('/flin.py')
@@ -30,14 +43,22 @@ class Flin(monome.App):
         self.channel = channel
         self.clockdiv = clockdiv
 
-        self.scale = [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72, 73]
+        self.scale = bytes([48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72, 73])
         self.play_tasks = []
 
+        # columns with their top led lit are kept as a bitmask; the note mask
+        # of each column mask seen so far is cached, there are at most 2 ** width
+        self.play_mask = 0
+        self.mask_notes = {}
+
     def on_grid_ready(self):
         self.grid.led_all(0)
-        self.play_tasks = [asyncio.async(asyncio.sleep(0)) for x in range(self.grid.width)]
         self.col_presses = [-1 for x in range(self.grid.width)]
-        self.play_row = [0 for x in range(self.grid.width)]
+        self.play_mask = 0
+        self.columns = [Column() for x in range(self.grid.width)]
+        # column levels last sent to the grid, None once anything else was drawn in the column
+        self.last_col = [None] * self.grid.width
+        self.play_tasks = [asyncio.ensure_future(self.play(x)) for x in range(self.grid.width)]
 
     def on_grid_disconnect(self):
         self.grid.led_all(0)
@@ -46,13 +67,13 @@ class Flin(monome.App):
 
     def on_grid_key(self, x, y, s):
         if y == (self.grid.height - 1):
-            self.play_tasks[x].cancel()
+            self.columns[x].set(0)
             return
         else:
             if s == 1:
                 if self.col_presses[x] == -1:
-                    # first button pressed, cancel player and store speed value
-                    self.play_tasks[x].cancel()
+                    # first button pressed, stop player and store speed value
+                    self.columns[x].set(0)
                     self.col_presses[x] = y
                 else:
                     # second button pressed, reset value and play
@@ -60,9 +81,9 @@ class Flin(monome.App):
                     dur = y + 1
                     self.col_presses[x] = -1
 
-                    self.play_tasks[x].cancel()
-                    self.play_tasks[x] = asyncio.async(self.play(x, speed, dur))
+                    self.columns[x].set(speed, dur)
                 self.grid.led_set(x, y, s) # light the led on press
+                self.last_col[x] = None
             else:
                 if self.col_presses[x] != -1:
                     # single button raised, so just use value
@@ -70,8 +91,7 @@ class Flin(monome.App):
                     dur = 1
                     self.col_presses[x] = -1
 
-                    self.play_tasks[x].cancel()
-                    self.play_tasks[x] = asyncio.async(self.play(x, speed, dur))
+                    self.columns[x].set(speed, dur)
                 else:
                     # one button raised, ignore rest
                     self.col_presses[x] = -1
@@ -79,43 +99,84 @@ class Flin(monome.App):
 
     # collect notes and send them to the synth
     def pipe(self):
-        notes = set()
-        for x in range(self.grid.width):
-            if self.play_row[x] == 1:
-                notes.add(self.scale[x])
-        self.synth.batch(self.channel, notes)
+        notes = self.mask_notes.get(self.play_mask)
+        if notes is None:
+            notes = 0
+            for x in range(self.grid.width):
+                if self.play_mask >> x & 1:
+                    notes |= 1 << self.scale[x]
+            self.mask_notes[self.play_mask] = notes
+        self.synth.batch_mask(self.channel, notes)
+
+    def set_playing(self, x, playing):
+        # the synth only needs to hear about columns that changed
+        mask = (self.play_mask & ~(1 << x)) | (playing << x)
+        if mask != self.play_mask:
+            self.play_mask = mask
+            self.pipe()
 
-    async def play(self, x, speed, dur):
+    def clear_column(self, x):
+        self.set_playing(x, 0)
+        self.grid.led_col(x, 0, [0] * self.grid.height)
+        self.last_col[x] = None
+
+    # one task per column for as long as the grid is connected, it restarts
+    # playback whenever the column settings change
+    async def play(self, x):
+        column = self.columns[x]
         try:
-            # use clock's q=1 here and below so we have even intervals instead of waiting for a full cycle
-            init_pos = await self.clock.sync()
-            new_pos = init_pos
             while True:
-                led_pos = (new_pos - init_pos) // (self.clockdiv * speed) % (self.grid.height * 2)
+                await column.changed.wait()
+                column.changed.clear()
+
+                if column.speed > 0:
+                    await self.play_column(x, column)
+        except asyncio.CancelledError:
+            pass
+
+    async def play_column(self, x, column):
+        # plays until the column settings change, then clears the column
+        speed, dur = column.speed, column.dur
+        step_ticks = self.clockdiv * speed
+
+        changed = asyncio.ensure_future(column.changed.wait())
+        tick = None
+        try:
+            # use clock's q=1 here so we have even intervals instead of waiting for a full cycle
+            await self.clock.sync()
+            # ticks counted from the first sync, so clock restarts don't
+            # throw the steps off
+            elapsed = 0
+            while not changed.done():
+                step = elapsed // step_ticks
+                led_pos = step % (self.grid.height * 2)
                 col = [4] * self.grid.height
 
                 # set column values
                 for i in range(led_pos, led_pos - dur, -1):
-                    if i in range(0, self.grid.height):
+                    if 0 <= i < self.grid.height:
                         col[i] = 15
 
                 # light bottom-most led so we know the column is active
                 if led_pos >= self.grid.height:
                     col[-1] = 15
 
-                self.play_row[x] = 1 if col[0] > 4 else 0
-                self.pipe()
+                self.set_playing(x, 1 if col[0] > 4 else 0)
 
-                self.grid.led_level_col(x, 0, col)
+                if col != self.last_col[x]:
+                    self.grid.led_level_col(x, 0, col)
+                    self.last_col[x] = col
 
-                # sync
-                for i in range(self.clockdiv * speed):
-                    new_pos = await self.clock.sync()
-
-        except asyncio.CancelledError:
-            self.play_row[x] = 0
-            self.pipe()
-            self.grid.led_col(x, 0, [0] * self.grid.height)
+                # sync to the next step, unless the settings change first
+                tick = asyncio.ensure_future(self.clock.wait_ticks((step + 1) * step_ticks - elapsed))
+                await asyncio.wait([tick, changed], return_when=asyncio.FIRST_COMPLETED)
+                if tick.done():
+                    elapsed += tick.result()
+        finally:
+            changed.cancel()
+            if tick:
+                tick.cancel()
+            self.clear_column(x)
 
     def quit(self):
         if self.grid:
@@ -134,7 +195,7 @@ if __name__ == '__main__':
     transport, renoise = loop.run_until_complete(coro)
 
     rays = Flin(clock, renoise, 1)
-    asyncio.async(monome.SerialOsc.create(loop=loop, autoconnect_app=rays))
+    asyncio.ensure_future(monome.SerialOsc.create(loop=loop, autoconnect_app=rays))
 
     try:
         loop.run_forever()
@@ -6,28 +6,121 @@
 #
 
 import asyncio
-import itertools
+import collections
 import random
 import monome
 
 import clocks
 import synths
 
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 EDIT_NOTE = 0
 EDIT_SUB = 1
 EDIT_VEL = 2
 EDIT_LINE = 3
 
-@asyncio.coroutine
-def blink(page, x, y, page_active):
-    # blink led (bypassing page buffering) as long as page_active returns True
-    if page_active():
+# rows 0-6 picked by every 7-bit column mask, so play() can choose one
+# without building lists
+MASK_ROWS = tuple(tuple(i for i in range(7) if mask >> i & 1) for mask in range(128))
+
+BLINK_TIME = 1/25
+
+class BlinkScheduler:
+    # blinks leds of a page (bypassing page buffering) as long as their
+    # page_active returns True; all blinks last equally long, so pending
+    # restores are kept in order in a deque and share a single timer.
+    # restores are dropped once the page has been refreshed, as the refresh
+    # redraws the blinked leds anyway
+    def __init__(self, page):
+        self.page = page
+        self.pending = collections.deque()
+        self.timer = None
+
+    def blink(self, x, y, page_active):
+        if not page_active():
+            return
+
+        page = self.page
         page.manager.led_level_set(x, y, 0 if page.buffer.levels[y][x] > 0 else 15)
 
-        yield from asyncio.sleep(1/25)
+        loop = asyncio.get_running_loop()
+        self.pending.append((loop.time() + BLINK_TIME, x, y, page_active, page.generation))
+        if self.timer is None:
+            self.timer = loop.call_at(self.pending[0][0], self.restore)
+
+    def restore(self):
+        loop = asyncio.get_running_loop()
+        page = self.page
+
+        while self.pending and self.pending[0][0] <= loop.time():
+            deadline, x, y, page_active, generation = self.pending.popleft()
+            if page.generation == generation and page_active():
+                page.manager.led_level_set(x, y, page.buffer.levels[y][x])
+
+        if self.pending:
+            self.timer = loop.call_at(self.pending[0][0], self.restore)
+        else:
+            self.timer = None
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.pending.clear()
+
+class FramePage(monome.Page):
+    # led writes go to the page buffer only; while the page is active, the
+    # 8x8 quads they touched are sent with one led_level_map each once the
+    # current loop iteration is done
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty_quads = 0
+        self.flush_handle = None
+        # bumped by refresh() on every full redraw
+        self.generation = 0
+
+    def led_set(self, x, y, s):
+        self.buffer.led_set(x, y, s)
+        self.mark_dirty(x, x, y)
+
+    def led_row(self, x_offset, y, data):
+        self.buffer.led_row(x_offset, y, data)
+        self.mark_dirty(x_offset, x_offset + len(data) - 1, y)
+
+    def mark_dirty(self, x0, x1, y):
+        # writes outside the page, like edit rows below an 8-row grid,
+        # leave no quads to send
+        x0, x1 = max(x0, 0), min(x1, self.width - 1)
+        if not 0 <= y < self.height or x0 > x1:
+            return
+
+        # quad (qx, qy) is bit qy * 16 + qx
+        for qx in range(x0 // 8, x1 // 8 + 1):
+            self.dirty_quads |= 1 << (y // 8 * 16 + qx)
 
-        if page_active():
-            page.manager.led_level_set(x, y, page.buffer.levels[y][x])
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        dirty, self.dirty_quads = self.dirty_quads, 0
+
+        # inactive pages are drawn from the buffer when they are switched to
+        if not self.is_active():
+            return
+
+        levels = self.buffer.levels
+        while dirty:
+            i = (dirty & -dirty).bit_length() - 1
+            dirty &= dirty - 1
+
+            x, y = i % 16 * 8, i // 16 * 8
+            self.manager.led_level_map(x, y, [row[x:x + 8] for row in levels[y:y + 8]])
 
 class ParcScene:
     def __init__(self, filename=None):
@@ -35,12 +128,13 @@ class ParcScene:
         # 4/ 2/ 1/ /2 /4 /8 /16 /32 6/ 3/ 1/ /3 /6 /12 /24 /48
         self.time = [384, 192,96,48, 24, 12, 6, 3, 576, 288, 96, 32, 16, 8, 4, 2]
 
-        self.notes = [
-            [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72],
-            [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72],
-            [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72],
-            [36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50],
-        ]
+        # midi notes all fit in a byte
+        self.notes = (
+            bytes([48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72]),
+            bytes([48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72]),
+            bytes([48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72]),
+            bytes([36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50]),
+        )
 
         self.vel_ranges = [(0, 127), (0, 127), (0, 127), (0, 127)]
         self.cc_ranges = [(0, 127), (0, 127), (0, 127), (0, 127)]
@@ -48,18 +142,22 @@ class ParcScene:
         self.midi_channels = [0, 1, 2, 3]
         self.midi_cc = [1, 2, 3, 4]
 
-        note_data  = []
-        sub_data = []
-        vel_data = []
-        line_data = []
+        # data holds every cell of every [mode][channel][row][col] grid in
+        # one flat bytearray, 16 cells per row and 15 rows per grid
+        self.data = bytearray(4 * 4 * 15 * 16)
 
-        for i in range(4):
-            note_data.append([[0 for col in range(16)] for row in range(15)])
-            sub_data.append([[0 for col in range(16)] for row in range(15)])
-            vel_data.append([[0 for col in range(16)] for row in range(15)])
-            line_data.append([[0 for col in range(16)] for row in range(15)])
+        # col_masks[mode][channel][col] has bit row set for each cell set in data
+        self.col_masks = [[[0 for col in range(16)] for channel in range(4)] for mode in range(4)]
+
+    def toggle(self, mode, channel, col, row):
+        i = ((mode * 4 + channel) * 15 + row) * 16 + col
+        self.data[i] ^= 1
+        self.col_masks[mode][channel][col] ^= 1 << row
+        return self.data[i]
 
-        self.data = [note_data, sub_data, vel_data, line_data]
+    def rows(self, mode, channel):
+        base = (mode * 4 + channel) * 15 * 16
+        return [self.data[i:i + 16] for i in range(base, base + 15 * 16, 16)]
 
     def load(self, filename):
         pass
@@ -67,7 +165,7 @@ class ParcScene:
     def save(self, filename):
         pass
 
-class GlobalView(monome.Page):
+class GlobalView(FramePage):
     def ready(self):
         super().ready()
 
@@ -88,23 +186,28 @@ class GlobalView(monome.Page):
                         self.manager.ranges[y] = (min(self.presses_range2[y]), max(self.presses_range2[y]) + 1)
                     else:
                         # single press, set position
-                        if x in range(*self.manager.ranges[y]):
+                        range_min, range_max = self.manager.ranges[y]
+                        if range_min <= x < range_max:
                             self.manager.positions[y - 4] = x
                     self.presses_range2[y].clear()
                     self.refresh()
         else:
             # position rows
             if s == 1:
-                self.manager.speeds[y - 4] = x
+                self.manager.set_speed(y - 4, x)
                 self.refresh()
 
     def refresh(self):
+        # range rows on top, speed rows below, built in a single pass; the
+        # page sends them as quad maps once refresh is done
+        self.generation += 1
         for y in range(4):
-            range_row = [1 if i in range(*self.manager.ranges[y]) else 0 for i in range(self.width)]
+            range_min, range_max = self.manager.ranges[y]
+            range_row = [0] * self.width
+            range_row[range_min:range_max] = [1] * (range_max - range_min)
             self.led_row(0, y, range_row)
 
-        for y in range(4):
-            speed_row = [0 for i in range(self.width)]
+            speed_row = [0] * self.width
             speed_row[self.manager.speeds[y]] = 1
             self.led_row(0, y+4, speed_row)
 
@@ -112,7 +215,7 @@ class GlobalView(monome.Page):
         # stub to keep manager happy
         pass
 
-class EditView(monome.Page):
+class EditView(FramePage):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.channel = 0
@@ -130,12 +233,12 @@ class EditView(monome.Page):
                 self.mode = x - 4
                 self.refresh()
         elif s == 1:
-            data = self.manager.scene.data[self.mode][self.channel]
-            data[y - 1][x] ^= 1
-            self.led_set(x, y, data[y - 1][x])
+            value = self.manager.scene.toggle(self.mode, self.channel, x, y - 1)
+            self.led_set(x, y, value)
 
     def refresh(self):
-        data = self.manager.scene.data[self.mode][self.channel]
+        self.generation += 1
+        data = self.manager.scene.rows(self.mode, self.channel)
 
         top_row = [0] * self.width
         top_row[self.channel] = 1
@@ -165,18 +268,29 @@ class Parc(monome.SeqPageManager):
         self.scene = ParcScene()
         self.play_tasks = []
 
+        self.global_blinks = BlinkScheduler(self.global_view)
+        self.edit_blinks = BlinkScheduler(self.edit_view)
+
     def ready(self):
         super().ready()
 
         self.ranges = [(0, self.width) for i in range(4)]
         self.speeds = [7 for i in range(4)]
+        self.speed_changed = [asyncio.Event() for i in range(4)]
         self.positions = [0 for i in range(4)]
 
+        # cc and velocity values of the 7 selectable rows for each channel,
+        # both are spread over cc_ranges, scaled to the grid height
+        self.cc_values = []
+        for cc_min, cc_max in self.scene.cc_ranges:
+            cc_div = (cc_max - cc_min) / self.height
+            self.cc_values.append([int(cc_max - (cc_div * i)) for i in range(7)])
+
         self.global_view.refresh()
         self.edit_view.refresh()
 
         for i in range(4):
-            self.play_tasks.append(asyncio.async(self.play(i)))
+            self.play_tasks.append(asyncio.ensure_future(self.play(i)))
 
     def disconnect(self):
         super().disconnect()
@@ -184,104 +298,127 @@ class Parc(monome.SeqPageManager):
         for task in self.play_tasks:
             task.cancel()
 
+        self.global_blinks.cancel()
+        self.edit_blinks.cancel()
+
         self.led_all(0)
         self.synth.panic()
 
-    @asyncio.coroutine
-    def play(self, channel):
+    def set_speed(self, channel, speed):
+        self.speeds[channel] = speed
+        self.speed_changed[channel].set()
+
+    async def wait_step(self, channel, n):
+        # waits for n ticks at once, or less if the channel's speed changes
+        changed = self.speed_changed[channel]
+        changed.clear()
+
+        ticks = asyncio.ensure_future(self.clock.wait_ticks(n))
+        speed = asyncio.ensure_future(changed.wait())
+        try:
+            await asyncio.wait([ticks, speed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ticks.cancel()
+            speed.cancel()
+
+    def beat_div(self, speed):
+        # step length in seconds; computed per step, since midi and osc
+        # clocks update bpm on every tick
+        return 60 / self.clock.bpm / 24 * self.scene.time[speed]
+
+    def edit_mode_active(self, channel, mode):
+        return lambda: self.edit_view.is_active() and \
+                       self.edit_view.channel == channel and \
+                       self.edit_view.mode == mode
+
+    async def play(self, channel):
         note_value = None
         sub_value = self.scene.sub[0]
         vel_value = self.scene.vel_ranges[channel][1]
         line_value = self.scene.cc_ranges[channel][0]
 
+        # blink conditions of this channel, built once instead of per blink
+        global_active = self.global_view.is_active
+        edit_active = self.edit_view.is_active
+        sub_active = self.edit_mode_active(channel, EDIT_SUB)
+        line_active = self.edit_mode_active(channel, EDIT_LINE)
+        vel_active = self.edit_mode_active(channel, EDIT_VEL)
+        note_active = self.edit_mode_active(channel, EDIT_NOTE)
+
+        note_masks = self.scene.col_masks[EDIT_NOTE][channel]
+        sub_masks = self.scene.col_masks[EDIT_SUB][channel]
+        vel_masks = self.scene.col_masks[EDIT_VEL][channel]
+        line_masks = self.scene.col_masks[EDIT_LINE][channel]
+
+        cc_values = self.cc_values[channel]
+        choice = random.choice
+
         # sync once to ensure further syncs are consistent across channels
-        yield from self.clock.sync(self.scene.time[self.speeds[channel]])
+        await self.clock.sync(self.scene.time[self.speeds[channel]])
 
         while True:
             pos = self.positions[channel]
 
-            asyncio.async(blink(self.global_view, pos, channel, lambda: self.global_view.is_active()))
+            self.global_blinks.blink(pos, channel, global_active)
 
-            note_col    = [row[pos] for row in self.scene.data[EDIT_NOTE][channel]]
-            sub_col     = [row[pos] for row in self.scene.data[EDIT_SUB][channel]]
-            vel_col     = [row[pos] for row in self.scene.data[EDIT_VEL][channel]]
-            line_col    = [row[pos] for row in self.scene.data[EDIT_LINE][channel]]
+            # rows set in the current column, only the first 7 are used
+            note_values = MASK_ROWS[note_masks[pos] & 0x7f]
+            sub_values = MASK_ROWS[sub_masks[pos] & 0x7f]
+            vel_values = MASK_ROWS[vel_masks[pos] & 0x7f]
+            line_values = MASK_ROWS[line_masks[pos] & 0x7f]
 
             # =====================
             # sub
             # =====================
-            sub_values = list(itertools.compress([0, 1, 2, 3, 4, 5, 6], sub_col))
             if sub_values:
-                sub_index = random.choice(sub_values)
+                sub_index = choice(sub_values)
                 sub_value = self.scene.sub[sub_index]
 
                 # blink sub
-                asyncio.async(blink(self.edit_view, pos, sub_index + 1,
-                    lambda: self.edit_view.is_active() and \
-                            self.edit_view.channel == channel and \
-                            self.edit_view.mode == EDIT_SUB))
+                self.edit_blinks.blink(pos, sub_index + 1, sub_active)
 
-            beat_div = 60 / self.clock.bpm / 24 * self.scene.time[self.speeds[channel]]
+            beat_div = self.beat_div(self.speeds[channel])
             sub_div = beat_div / sub_value
 
             for i in range(sub_value):
                 # =====================
                 # line
                 # =====================
-                line_values = list(itertools.compress([0, 1, 2, 3, 4, 5, 6], line_col))
                 if line_values:
-                    line_index = random.choice(line_values)
-
-                    line_min, line_max = self.scene.cc_ranges[channel]
-                    line_div = (line_max - line_min) / self.height
-                    line_value = int(line_max - (line_div * line_index))
+                    line_index = choice(line_values)
+                    line_value = cc_values[line_index]
 
                     # blink line
-                    asyncio.async(blink(self.edit_view, pos, line_index + 1,
-                        lambda: self.edit_view.is_active() and \
-                                self.edit_view.channel == channel and \
-                                self.edit_view.mode == EDIT_LINE))
+                    self.edit_blinks.blink(pos, line_index + 1, line_active)
 
                     self.synth.cc(channel, self.scene.midi_cc[channel], line_value)
 
                 # =====================
                 # vel
                 # =====================
-                vel_values = list(itertools.compress([0, 1, 2, 3, 4, 5, 6], vel_col))
                 if vel_values:
-                    vel_index = random.choice(vel_values)
-
-                    vel_min, vel_max = self.scene.cc_ranges[channel]
-                    vel_div = (vel_max - vel_min) / self.height
-                    vel_value = int(vel_max - (vel_div * vel_index))
+                    vel_index = choice(vel_values)
+                    vel_value = cc_values[vel_index]
 
                     # blink vel
-                    asyncio.async(blink(self.edit_view, pos, vel_index + 1,
-                        lambda: self.edit_view.is_active() and \
-                                self.edit_view.channel == channel and \
-                                self.edit_view.mode == EDIT_VEL))
+                    self.edit_blinks.blink(pos, vel_index + 1, vel_active)
 
                 # =====================
                 # note
                 # =====================
-                note_values = list(itertools.compress([0, 1, 2, 3, 4, 5, 6], note_col))
                 if note_values:
                     # note_off_previous note
                     if note_value is not None:
                         self.synth.note_off(channel, note_value)
                         note_value = None
-                    note_index = random.choice(note_values)
+                    note_index = choice(note_values)
                     note_value = self.scene.notes[channel][note_index]
 
                     # blink note
-                    asyncio.async(blink(self.edit_view, pos, note_index + 1,
-                        lambda: self.edit_view.is_active() and \
-                                self.edit_view.channel == channel and \
-                                self.edit_view.mode == EDIT_NOTE))
+                    self.edit_blinks.blink(pos, note_index + 1, note_active)
 
                     # blink in the top row
-                    asyncio.async(blink(self.edit_view, channel, 0,
-                        lambda: self.edit_view.is_active()))
+                    self.edit_blinks.blink(channel, 0, edit_active)
 
                     self.synth.note_on(self.scene.midi_channels[channel], note_value, vel_value)
                 else:
@@ -292,27 +429,28 @@ class Parc(monome.SeqPageManager):
 
                 # sleep for sub_div ms if we're still retriggering
                 if i < sub_value - 1:
-                    yield from asyncio.sleep(sub_div)
+                    await asyncio.sleep(sub_div)
 
             # advance position
-            self.positions[channel] += 1
-            if self.positions[channel] not in range(*self.ranges[channel]):
-                self.positions[channel] = self.ranges[channel][0]
+            range_min, range_max = self.ranges[channel]
+            pos = self.positions[channel] + 1
+            if not range_min <= pos < range_max:
+                pos = range_min
+            self.positions[channel] = pos
 
             # sync manually, so we can catch speed changes in the middle of a sync
-            tick = yield from self.clock.sync()
+            tick = await self.clock.sync()
             while tick % self.scene.time[self.speeds[channel]] != 0:
-                tick = yield from self.clock.sync()
+                time = self.scene.time[self.speeds[channel]]
+                await self.wait_step(channel, time - tick % time)
+                tick = self.clock.ticks
 
 
-@asyncio.coroutine
-def cleanup():
-    yield from asyncio.sleep(0.2)
+async def cleanup():
+    await asyncio.sleep(0.2)
 
 if __name__ == '__main__':
-    from concurrent.futures import ThreadPoolExecutor
     loop = asyncio.get_event_loop()
-    loop.set_default_executor(ThreadPoolExecutor(100))
 
     # create clock
     #coro = loop.create_datagram_endpoint(clocks.FooClock, local_addr=('127.0.0.1', 9000))
@@ -8,6 +8,19 @@ def pack_midi(message, channel, data1, data2):
     channel = channel - 1
     return ((data2 & 127) << 16) | ((data1 & 127) << 8) | ((message & 15) << 4) | (channel & 15)
 
+# status byte of a message type for each channel & 15, same as pack_midi
+def status_table(message):
+    return [((message & 15) << 4) | ((channel - 1) & 15) for channel in range(16)]
+
+NOTE_ON_STATUS = status_table(0b1001)
+NOTE_OFF_STATUS = status_table(0b1000)
+CC_STATUS = status_table(0b1011)
+
+# renoise midi messages only differ in their int argument, so everything
+# before it is packed once
+RENOISE_MIDI_PREFIX = aiosc.pack_string('/renoise/trigger/midi') + aiosc.pack_string(',i')
+RENOISE_MIDI_ARG = struct.Struct('>i')
+
 class Synth(aiosc.OSCProtocol):
     def __init__(self):
         self.batches = {}
@@ -25,32 +38,44 @@ class Synth(aiosc.OSCProtocol):
         pass
 
     def batch(self, channel, batch):
-        old_notes = self.batches.get(channel, set())
-        note_offs = old_notes.difference(batch)
-        note_ons = batch.difference(old_notes)
-        self.batches[channel] = batch.copy()
+        mask = 0
+        for n in batch:
+            mask |= 1 << n
+        self.batch_mask(channel, mask)
+
+    def batch_mask(self, channel, mask):
+        # same as batch, with the notes given as a bitmask, bit n for note n
+        old_mask = self.batches.get(channel, 0)
+        note_ons = mask & ~old_mask
+        note_offs = old_mask & ~mask
+        self.batches[channel] = mask
 
-        for n in note_ons:
+        while note_ons:
+            n = (note_ons & -note_ons).bit_length() - 1
+            note_ons &= note_ons - 1
             self.note_on(channel, n, random.randint(64, 127))
 
-        for n in note_offs:
+        while note_offs:
+            n = (note_offs & -note_offs).bit_length() - 1
+            note_offs &= note_offs - 1
             self.note_off(channel, n)
 
 class Renoise(Synth):
     def __init__(self):
         super().__init__()
 
+    def send_midi(self, midi):
+        # the same datagram as self.send('/renoise/trigger/midi', midi)
+        self.transport.sendto(RENOISE_MIDI_PREFIX + RENOISE_MIDI_ARG.pack(midi))
+
     def note_on(self, channel, note, velocity):
-        midi = pack_midi(0b1001, channel, note, velocity)
-        self.send('/renoise/trigger/midi', midi)
+        self.send_midi(((velocity & 127) << 16) | ((note & 127) << 8) | NOTE_ON_STATUS[channel & 15])
 
     def note_off(self, channel, note):
-        midi = pack_midi(0b1000, channel, note, 0)
-        self.send('/renoise/trigger/midi', midi)
+        self.send_midi(((note & 127) << 8) | NOTE_OFF_STATUS[channel & 15])
 
     def cc(self, channel, controller, value):
-        midi = pack_midi(0b1011, channel, controller, value)
-        self.send('/renoise/trigger/midi', midi)
+        self.send_midi(((value & 127) << 16) | ((controller & 127) << 8) | CC_STATUS[channel & 15])
 
     def program_change(self, channel, program):
         midi = pack_midi(0b1100, channel, program, 0)